@@ -1,15 +1,99 @@
-import json, os, time, asyncio
+import json, os, time, asyncio, atexit, hashlib
+from collections import deque
 from datetime import datetime
 from typing import Any, Dict, List, Tuple
 import httpx
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, Field
 from tenacity import retry, stop_after_attempt, wait_exponential
 from config import Settings
-from core import ReviewAgent
+from core import ReviewAgent, Finding
 
 app = FastAPI(title="AI PR Review", version="1.0.0")
 
+SETTINGS = Settings()
+POOL_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=90)
+GH_TIMEOUT = httpx.Timeout(connect=5, read=30, write=30, pool=5)
+
+class MetricsLog:
+    def __init__(self, path: str = "review_metrics.jsonl", max_buf: int = 1<<16, keep: int = 20):
+        self.path = path
+        self.max_buf = max_buf
+        self.buf: List[str] = []
+        self.buf_bytes = 0
+        self.recent: deque = deque(maxlen=keep)
+        self._fh = None
+
+    def append(self, entry: Dict[str,Any]) -> None:
+        line = json.dumps(entry) + "\n"
+        self.recent.append(entry)
+        self.buf.append(line)
+        self.buf_bytes += len(line)
+        if self.buf_bytes >= self.max_buf:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.buf:
+            return
+        if self._fh is None:
+            self._fh = open(self.path, "a", encoding="utf-8", buffering=1<<16)
+        self._fh.writelines(self.buf)
+        self._fh.flush()
+        self.buf.clear()
+        self.buf_bytes = 0
+
+    async def flusher(self, interval: float = 0.1) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.flush()
+
+    def tail(self, n: int = 20) -> List[Dict[str,Any]]:
+        if self.recent:
+            return list(self.recent)[-n:]
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(0, 2)
+                end = f.tell()
+                buf = b""
+                while end > 0 and buf.count(b"\n") <= n:
+                    step = min(8192, end)
+                    end -= step
+                    f.seek(end)
+                    buf = f.read(step) + buf
+                if end > 0:
+                    buf = buf.split(b"\n", 1)[1] if b"\n" in buf else b""
+            return [json.loads(l) for l in buf.splitlines() if l.strip()][-n:]
+        except Exception:
+            return []
+
+METRICS = MetricsLog()
+atexit.register(METRICS.flush)
+
+AGENT = ReviewAgent(SETTINGS)
+
+@app.on_event("startup")
+async def _startup():
+    headers = {"Accept": "application/vnd.github+json"}
+    if SETTINGS.github_token:
+        headers["Authorization"] = f"token {SETTINGS.github_token}"
+    app.state.gh_client = httpx.AsyncClient(http2=True, headers=headers, timeout=GH_TIMEOUT, limits=POOL_LIMITS)
+    app.state.llm_client = httpx.AsyncClient(timeout=SETTINGS.llm_timeout, limits=POOL_LIMITS)
+    app.state.router = LLMRouter(SETTINGS, client=app.state.llm_client)
+    app.state.metrics_task = asyncio.create_task(METRICS.flusher())
+    app.state.ready_task = asyncio.create_task(app.state.router.keep_ready_loop())
+
+@app.on_event("shutdown")
+async def _shutdown():
+    app.state.ready_task.cancel()
+    app.state.metrics_task.cancel()
+    METRICS.flush()
+    await app.state.gh_client.aclose()
+    await app.state.llm_client.aclose()
+
 class ReviewRequest(BaseModel):
     repository: Dict[str, Any]
     pull_request: Dict[str, Any]
@@ -26,9 +110,13 @@ class ReviewResponse(BaseModel):
     retrieval_hits: int = 0
 
 class LLMRouter:
-    def __init__(self, settings: Settings):
+    def __init__(self, settings: Settings, client: httpx.AsyncClient | None = None):
         self.s = settings
+        self.client = client
         self.cache: Tuple[bool,float] | None = None
+        self._providers: List[Dict[str,str]] | None = None
+        self._chat_cache: Dict[str, Tuple[float, str]] = {}
+        self.chat_ttl = 300.0
         self.alias = {
             "openai": {"fast":"gpt-4o-mini","balanced":"gpt-4o-mini","quality":"gpt-4o"},
             "openrouter": {"fast":"openai/gpt-4o-mini","balanced":"openai/gpt-4o-mini","quality":"anthropic/claude-3.5-sonnet"},
@@ -52,58 +140,106 @@ class LLMRouter:
         return order
 
     def select(self) -> List[Dict[str,str]]:
+        if self._providers is not None:
+            return self._providers
         tier = self.s.llm_tier if self.s.llm_tier in ("fast","balanced","quality") else "balanced"
         provs = []
         for name, key, base in self.discover():
             model = self.alias.get(name, {}).get(tier, "")
             provs.append({"name":name,"key":key,"base":base,"model":model})
+        self._providers = provs
         return provs
 
-    def ready(self) -> bool:
+    def _async_client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=self.s.llm_timeout, limits=POOL_LIMITS)
+        return self.client
+
+    async def ready(self) -> bool:
         now = time.time()
         if self.cache and now - self.cache[1] < 120:
             return self.cache[0]
         ok = False
         for p in self.select():
             try:
-                with httpx.Client(timeout=10) as c:
-                    r = c.post(p["base"], json={"model":p["model"],"messages":[{"role":"user","content":"ping"}],"max_tokens":5}, headers={"Authorization":f"Bearer {p['key']}"})
-                    if r.status_code < 300:
-                        ok = True
-                        break
+                r = await self._async_client().post(p["base"], json={"model":p["model"],"messages":[{"role":"user","content":"ping"}],"max_tokens":5}, headers={"Authorization":f"Bearer {p['key']}"}, timeout=10)
+                if r.status_code < 300:
+                    ok = True
+                    break
             except Exception:
                 continue
         self.cache = (ok, now)
         return ok
 
+    async def keep_ready_loop(self, interval: float = 120.0) -> None:
+        while True:
+            self.cache = None
+            try:
+                await self.ready()
+            except Exception:
+                pass
+            await asyncio.sleep(interval)
+
+    async def chat_cached(self, system_msg: str, user_msg: str, max_tokens: int) -> Tuple[str, int]:
+        key = hashlib.blake2b(f"{system_msg}\x00{user_msg}".encode(), digest_size=16).hexdigest()
+        hit = self._chat_cache.get(key)
+        now = time.time()
+        if hit and now - hit[0] < self.chat_ttl:
+            return hit[1], 0
+        txt, used = await self.chat(system_msg, user_msg, max_tokens)
+        if txt:
+            self._chat_cache[key] = (now, txt)
+        return txt, used
+
+    async def _chat_one(self, p: Dict[str,str], system_msg: str, user_msg: str, max_tokens: int) -> Tuple[str, int]:
+        payload = {"model": p["model"], "messages":[{"role":"system","content":system_msg},{"role":"user","content":user_msg}], "max_tokens": max_tokens, "temperature": 0.2}
+        r = await self._async_client().post(p["base"], json=payload, headers={"Authorization": f"Bearer {p['key']}"})
+        if r.status_code == 429:
+            retry_after = int(r.headers.get("retry-after","15"))
+            await asyncio.sleep(min(retry_after, 30))
+        r.raise_for_status()
+        data = r.json()
+        txt = data.get("choices",[{}])[0].get("message",{}).get("content","")
+        used = int(data.get("usage",{}).get("total_tokens", 0) or 0)
+        return txt, used
+
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
     async def chat(self, system_msg: str, user_msg: str, max_tokens: int) -> Tuple[str, int]:
-        for p in self.select():
+        provs = self.select()
+        if not provs:
+            return "", 0
+        # hedge across the two fastest-discovered providers, serial fallback for the rest
+        tasks = {asyncio.create_task(self._chat_one(p, system_msg, user_msg, max_tokens)) for p in provs[:2]}
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED, timeout=self.s.llm_timeout)
+                if not done:
+                    break
+                for t in done:
+                    if not t.exception():
+                        return t.result()
+        finally:
+            for t in tasks:
+                t.cancel()
+        for p in provs[2:]:
             try:
-                payload = {"model": p["model"], "messages":[{"role":"system","content":system_msg},{"role":"user","content":user_msg}], "max_tokens": max_tokens, "temperature": 0.2}
-                async with httpx.AsyncClient(timeout=self.s.llm_timeout) as c:
-                    r = await c.post(p["base"], json=payload, headers={"Authorization": f"Bearer {p['key']}"})
-                if r.status_code == 429:
-                    retry_after = int(r.headers.get("retry-after","15"))
-                    await asyncio.sleep(min(retry_after, 30))
-                    continue
-                if r.status_code >= 500:
-                    continue
-                r.raise_for_status()
-                data = r.json()
-                txt = data.get("choices",[{}])[0].get("message",{}).get("content","")
-                used = int(data.get("usage",{}).get("total_tokens", 0) or 0)
-                return txt, used
+                return await self._chat_one(p, system_msg, user_msg, max_tokens)
             except Exception:
                 continue
         return "", 0
 
 class GitHub:
-    def __init__(self, token: str):
-        self.client = httpx.AsyncClient(headers={"Authorization": f"token {token}"}, timeout=30.0) if token else None
+    def __init__(self, token: str, client: httpx.AsyncClient | None = None):
+        # without a token, posting is skipped entirely (client stays None)
+        # rather than firing unauthenticated calls through a shared client
+        if client is not None and token:
+            self.client, self._owns = client, False
+        else:
+            self.client = httpx.AsyncClient(http2=True, headers={"Authorization": f"token {token}", "Accept": "application/vnd.github+json"}, timeout=GH_TIMEOUT, limits=POOL_LIMITS) if token else None
+            self._owns = True
 
     async def close(self):
-        if self.client:
+        if self.client and self._owns:
             await self.client.aclose()
 
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=8))
@@ -114,6 +250,14 @@ class GitHub:
         r = await self.client.post(url, json=payload)
         return r.status_code == 201
 
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=8))
+    async def post_review(self, repo: str, pr: int, commit_id: str, comments: List[Finding]) -> int:
+        if not self.client or not comments: return 0
+        url = f"https://api.github.com/repos/{repo}/pulls/{pr}/reviews"
+        payload = {"commit_id": commit_id, "event": "COMMENT", "comments": [{"path": c.path, "line": c.line, "side": "RIGHT", "body": c.body} for c in comments]}
+        r = await self.client.post(url, json=payload)
+        return len(comments) if r.status_code < 300 else 0
+
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=8))
     async def summary(self, repo: str, pr: int, body: str) -> bool:
         if not self.client: return False
@@ -122,60 +266,80 @@ class GitHub:
         return r.status_code == 201
 
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=8))
-    async def check_run(self, repo: str, head_sha: str, findings: List[Dict[str,Any]]) -> bool:
+    async def check_run(self, repo: str, head_sha: str, findings: List[Finding]) -> bool:
         if not self.client: return False
         anns = []
         for f in findings[:50]:
-            lvl = "warning" if f.get("confidence",0) >= 0.85 else "notice"
-            anns.append({"path": f["path"], "start_line": f["line"], "end_line": f["line"], "annotation_level": lvl, "message": f["body"][:65535]})
+            lvl = "warning" if f.confidence >= 0.85 else "notice"
+            anns.append({"path": f.path, "start_line": f.line, "end_line": f.line, "annotation_level": lvl, "message": f.body[:65535]})
         url = f"https://api.github.com/repos/{repo}/check-runs"
         payload = {"name":"AI Code Review","head_sha": head_sha,"status":"completed","conclusion":"neutral","output":{"title":f"AI review: {len(anns)} annotations","summary":"AI review completed","annotations":anns}}
         r = await self.client.post(url, json=payload)
         return r.status_code == 201
 
-def sarif(findings: List[Dict[str,Any]], repo_uri: str) -> Dict[str,Any]:
-    res = []
-    for f in findings:
-        lvl = "warning" if f.get("confidence",0) >= 0.85 else "note"
-        res.append({"ruleId":"ai-review","level":lvl,"message":{"text":f["body"][:65535]},"locations":[{"physicalLocation":{"artifactLocation":{"uri":f["path"]},"region":{"startLine":f["line"]}}}]})
+def sarif(findings: List[Finding], repo_uri: str) -> Dict[str,Any]:
+    res: List[Dict[str,Any]] = [None] * len(findings)
+    for i, f in enumerate(findings):
+        lvl = "warning" if f.confidence >= 0.85 else "note"
+        res[i] = {"ruleId":"ai-review","level":lvl,"message":{"text":f.body[:65535]},"locations":[{"physicalLocation":{"artifactLocation":{"uri":f.path},"region":{"startLine":f.line}}}]}
     return {"version":"2.1.0","runs":[{"tool":{"driver":{"name":"AI PR Review","version":"1.0.0","rules":[{"id":"ai-review","shortDescription":{"text":"AI code review"},"fullDescription":{"text":"AI analysis of code changes"}}]}},"results":res}]}
 
+def write_sarif(data: Dict[str,Any], path: str = "results.sarif") -> None:
+    if orjson is not None:
+        with open(path,"wb") as f: f.write(orjson.dumps(data))
+    else:
+        with open(path,"w",encoding="utf-8") as f: json.dump(data,f)
+
 class Service:
-    def __init__(self):
-        self.s = Settings()
-        self.router = LLMRouter(self.s)
-        self.agent = ReviewAgent(self.s)
+    def __init__(self, gh_client: httpx.AsyncClient | None = None, llm_client: httpx.AsyncClient | None = None, router: "LLMRouter | None" = None):
+        self.s = SETTINGS
+        self.gh_client = gh_client
+        self.router = router if router is not None else LLMRouter(self.s, client=llm_client)
+        self.agent = AGENT
 
     def _log_metrics(self, m: Dict[str,Any]) -> None:
-        entry = {"timestamp": datetime.utcnow().isoformat(), "type": "review_metrics", **m}
-        with open("review_metrics.jsonl","a",encoding="utf-8") as f: f.write(json.dumps(entry)+"\n")
+        METRICS.append({"timestamp": datetime.utcnow().isoformat(), "type": "review_metrics", **m})
 
     async def run(self, req: ReviewRequest) -> ReviewResponse:
         t0 = time.time()
         repo = req.repository.get("full_name","")
         prn = int(req.pull_request.get("number",0) or 0)
-        self.agent.initialize_repository(".", changed_files=req.pull_request.get("changed_files",[]))
-        rr = self.agent.review_changes(req.diff_content or "", req.pull_request.get("changed_files",[]), req.pull_request)
-        gh = GitHub(self.s.github_token)
+        await asyncio.to_thread(self.agent.initialize_repository, ".", changed_files=req.pull_request.get("changed_files",[]))
+        rr = await asyncio.to_thread(self.agent.review_changes, req.diff_content or "", req.pull_request.get("changed_files",[]), req.pull_request)
+        gh = GitHub(self.s.github_token, client=self.gh_client)
         comments_posted = 0
         summary_posted = False
         check_run_created = False
         tokens_used = 0
         try:
-            ready = self.router.ready()
-            findings = []
-            for c in rr.get("inline_comments", []):
-                is_high = c.get("confidence",0) >= 0.85 or ("security" in c["body"].lower() or "secret" in c["body"].lower())
-                if ready:
-                    sys = "You review code changes. Ground your feedback in the provided snippets. Return concise, actionable text."
-                    usr = c["body"][:4000]
-                    txt, used = await self.router.chat(sys, usr, self.s.max_tokens)
+            ready = await self.router.ready()
+            findings = rr.get("inline_comments", [])
+            high = []
+            for c in findings:
+                body_lower = c.body.lower()
+                if c.confidence >= 0.85 or "security" in body_lower or "secret" in body_lower:
+                    high.append(c)
+            if ready and high:
+                sys = "You review code changes. Ground your feedback in the provided snippets. Return concise, actionable text."
+                rewrites = await asyncio.gather(*[self.router.chat_cached(sys, c.body[:4000], self.s.max_tokens) for c in high], return_exceptions=True)
+                for c, res in zip(high, rewrites):
+                    if isinstance(res, Exception): continue
+                    txt, used = res
                     tokens_used += used
-                    if txt: c["body"] = txt
-                if is_high:
-                    ok = await gh.inline(repo, prn, c["path"], c["line"], c["body"])
-                    if ok: comments_posted += 1
-                findings.append(c)
+                    if txt: c.body = txt
+            head_sha = os.getenv("HEAD_SHA","")
+            if head_sha:
+                comments_posted = await gh.post_review(repo, prn, head_sha, high)
+            if high and not comments_posted:
+                # the batched review is all-or-nothing: one comment anchored on
+                # a line outside the diff 422s the whole call, so fall back to
+                # per-comment posting where only the invalid ones are lost
+                sem = asyncio.Semaphore(8)
+                async def _post_one(c):
+                    async with sem:
+                        return await gh.inline(repo, prn, c.path, c.line, c.body)
+                posted = await asyncio.gather(*[_post_one(c) for c in high], return_exceptions=True)
+                comments_posted = sum(1 for ok in posted if ok is True)
             summary = rr.get("summary","")
             if ready and summary:
                 sys = "Summarize issues into crisp bullets. Do not repeat file content."
@@ -185,12 +349,10 @@ class Service:
                 if txt: summary = txt
             if summary:
                 summary_posted = await gh.summary(repo, prn, summary)
-            head_sha = os.getenv("HEAD_SHA","")
             if head_sha and self.s.enable_check_runs:
                 check_run_created = await gh.check_run(repo, head_sha, findings)
             if self.s.enable_sarif:
-                data = sarif(findings, f"https://github.com/{repo}")
-                with open("results.sarif","w",encoding="utf-8") as f: json.dump(data,f)
+                write_sarif(sarif(findings, f"https://github.com/{repo}"))
             lat = time.time()-t0
             self._log_metrics({"repo":repo,"pr_number":prn,"latency_seconds":lat,"comments_posted":comments_posted,"summary_posted":summary_posted,"tokens_used":tokens_used,"retrieval_hits":int(rr.get("retrieval_hits",0)),"retrieval_hit_rate":float(rr.get("retrieval_hit_rate_at_k",0.0)),"rule_counts":rr.get("rule_counts",{})})
             await gh.close()
@@ -201,7 +363,7 @@ class Service:
 
 @app.post("/review", response_model=ReviewResponse)
 async def review_endpoint(request: ReviewRequest):
-    svc = Service()
+    svc = Service(gh_client=app.state.gh_client, llm_client=app.state.llm_client, router=app.state.router)
     return await svc.run(request)
 
 @app.get("/health")
@@ -211,11 +373,6 @@ async def health():
 @app.get("/metrics")
 async def metrics():
     try:
-        out=[]
-        if os.path.exists("review_metrics.jsonl"):
-            with open("review_metrics.jsonl","r",encoding="utf-8") as f:
-                for ln in f:
-                    if ln.strip(): out.append(json.loads(ln))
-        return {"metrics": out[-20:]}
+        return {"metrics": METRICS.tail(20)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -4,8 +4,14 @@ import os
 class Settings(BaseSettings):
     github_token: str = os.getenv("GITHUB_TOKEN", "")
     embed_model: str = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+    embed_batch: int = int(os.getenv("EMBED_BATCH", "128"))
     store_dir: str = os.getenv("STORE_DIR", ".rag/faiss")
     top_k: int = int(os.getenv("TOP_K", "6"))
+    ivf_threshold: int = int(os.getenv("IVF_THRESHOLD", "50000"))
+    nlist: int = int(os.getenv("NLIST", "1024"))
+    pq_m: int = int(os.getenv("PQ_M", "16"))
+    nprobe: int = int(os.getenv("NPROBE", "16"))
+    mmap_index: bool = os.getenv("MMAP_INDEX", "false").lower() == "true"
     max_tokens: int = int(os.getenv("MAX_TOKENS", "512"))
     confidence_threshold: float = float(os.getenv("CONFIDENCE_THRESHOLD", "0.75"))
     llm_tier: str = os.getenv("LLM_TIER", "balanced")
@@ -1,73 +1,113 @@
-import ast, re, os
-from typing import Any, Dict, List, Tuple
+import ast, re, os, hashlib, threading, bisect
+from dataclasses import dataclass
+from typing import Any, Dict, List, Set, Tuple
 from config import Settings
 from store import EmbedStore
 
-SEC_SECRET = re.compile(r"(?:ghp_|AKIA|ASIA|xoxb-|xoxp-|eyJ[A-Za-z0-9_-]{10,})")
-SEC_PWD = re.compile(r"password\s*=\s*['\"][^'^\"]+['\"]", re.IGNORECASE)
-SEC_SQLI = re.compile(r"(execute|query)\s*\(\s*['\"].*?\+.*?['\"]", re.IGNORECASE)
-DBG_PRINT = re.compile(r"\bprint\s*\(")
+@dataclass(slots=True)
+class Finding:
+    path: str
+    line: int
+    body: str
+    confidence: float
+
+FUSED_SCAN = re.compile(
+    r"(?P<todo>(?i:TODO|FIXME|HACK|XXX))"
+    r"|(?P<pwd>(?i:password\s*=\s*['\"][^'^\"]+['\"]))"
+    r"|(?P<sqli>(?i:(?:execute|query)\s*\(\s*['\"].*?\+.*?['\"]))"
+    r"|(?P<dbg>\bprint\s*\()"
+)
+# scanned on its own pass: inside the alternation a pwd match would consume
+# (and hide) a token embedded in the password string
+SECRET_RE = re.compile(r"ghp_|AKIA|ASIA|xoxb-|xoxp-|eyJ[A-Za-z0-9_-]{10,}")
 
 def redact(s: str) -> str:
     return re.sub(r"ghp_[A-Za-z0-9]{20,}", "ghp_REDACTED", s)
 
-def parse_unified_diff(diff: str) -> Dict[str, List[int]]:
-    lines = diff.splitlines()
+DIFF_SCAN = re.compile(
+    r"^\+\+\+ b/(?P<file>[^\n]*)"
+    r"|^@@ (?P<hdr>[^\n]*)"
+    r"|^(?P<add>\+)(?!\+\+)"
+    r"|^(?P<drop>-)(?!--)"
+    r"|^(?P<keep>[^\n]?)",
+    re.MULTILINE
+)
+HUNK_START = re.compile(r"\+(\d+)(?:,(\d+))?")
+
+def parse_unified_diff(diff: str) -> Dict[str, Set[int]]:
     cur, added, plus = None, {}, 0
-    for ln in lines:
-        if ln.startswith("+++ b/"):
-            cur = ln[6:].strip()
-            added.setdefault(cur, [])
-        elif ln.startswith("@@ "):
-            m = re.search(r"\+(\d+)(?:,(\d+))?", ln)
-            plus = int(m.group(1)) if m else 0
-        elif ln.startswith("+") and not ln.startswith("+++"):
+    for m in DIFF_SCAN.finditer(diff):
+        g = m.lastgroup
+        if g == "add":
             if cur and plus:
                 added[cur].append(plus)
-            if cur and plus:
                 plus += 1
-        elif ln.startswith("-") and not ln.startswith("---"):
-            continue
-        else:
+        elif g == "keep":
             if cur and plus:
                 plus += 1
-    return {k: sorted(set(v)) for k, v in added.items()}
+        elif g == "hdr":
+            hm = HUNK_START.search(m.group("hdr"))
+            plus = int(hm.group(1)) if hm else 0
+        elif g == "file":
+            cur = m.group("file").strip()
+            added.setdefault(cur, [])
+    return {k: set(v) for k, v in added.items()}
 
 class ReviewAgent:
     def __init__(self, settings: Settings):
         self.settings = settings
         self.store: EmbedStore | None = None
+        self._indexed_path: str | None = None
+        self._analyze_cache: Dict[bytes, Tuple[str, Dict[str, int], float]] = {}
+        # the agent (and its store) is shared across requests and driven from
+        # to_thread workers; concurrent index_repo/search would race on the
+        # faiss index, docstore and manifest files
+        self._lock = threading.Lock()
 
-    def initialize_repository(self, repo_path: str, changed_files: List[str] | None = None):
-        self.store = EmbedStore(self.settings)
-        self.store.index_repo(repo_path, changed_files=changed_files)
+    def initialize_repository(self, repo_path: str, changed_files: List[str] | None = None) -> None:
+        with self._lock:
+            if self.store is None or self._indexed_path != repo_path:
+                self.store = EmbedStore(self.settings)
+                self._indexed_path = repo_path
+            self.store.index_repo(repo_path, changed_files=changed_files)
 
     def review_changes(self, diff_content: str, changed_files: List[str], pr_context: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            return self._review_changes(diff_content, changed_files, pr_context)
+
+    def _review_changes(self, diff_content: str, changed_files: List[str], pr_context: Dict[str, Any]) -> Dict[str, Any]:
         spans = parse_unified_diff(diff_content)
         comments, counts, hits = [], self._zero_counts(), 0
+        pending = []
         for fp in changed_files:
             if not os.path.exists(fp):
                 continue
             chunks = self.store.chunk_file(fp) if self.store else []
             for text, meta in chunks:
-                if not self._overlaps(meta.get("lines", []), spans.get(fp, [])):
+                if not self._overlaps(meta.get("lines", []), spans.get(fp, set())):
                     continue
-                ctx = self.store.hybrid_search(text, k=self.settings.top_k) if self.store else []
-                hits += len(ctx)
-                issues, inc, conf = self._analyze(text)
-                for k, v in inc.items():
-                    counts[k] += v
-                if not issues or conf < self.settings.confidence_threshold:
-                    continue
-                neighbors = []
-                for t, m, _ in ctx[:5]:
-                    neighbors.append({
-                        "file": m.get("file", ""),
-                        "lines": m.get("lines", []),
-                        "text": "\n".join(t.splitlines()[:40])
-                    })
-                body = self._format_body(fp, meta.get("lines", [1])[0], issues, neighbors, conf)
-                comments.append({"path": fp, "line": meta.get("lines", [1])[0], "body": body, "confidence": conf})
+                pending.append((fp, text, meta))
+        if self.store and pending:
+            ctxs = self.store.hybrid_search_batch([text for _, text, _ in pending], k=self.settings.top_k)
+        else:
+            ctxs = [[] for _ in pending]
+        for (fp, text, meta), ctx in zip(pending, ctxs):
+            hits += len(ctx)
+            issues, inc, conf = self._analyze_cached(text)
+            for k, v in inc.items():
+                counts[k] += v
+            if not issues or conf < self.settings.confidence_threshold:
+                continue
+            neighbors = []
+            for t, m, _ in ctx[:5]:
+                neighbors.append({
+                    "file": m.get("file", ""),
+                    "lines": m.get("lines", []),
+                    "text": "\n".join(t.splitlines()[:40])
+                })
+            line = meta.get("lines", [1])[0]
+            body = self._format_body(fp, line, issues, neighbors, conf)
+            comments.append(Finding(fp, line, body, conf))
         return {
             "inline_comments": comments,
             "summary": self._summary(self._ordered_counts(counts), comments),
@@ -77,14 +117,10 @@ class ReviewAgent:
             "tokens_used": 0
         }
 
-    def _overlaps(self, lines: List[int], added: List[int]) -> bool:
+    def _overlaps(self, lines: Tuple[int, int], added: Set[int]) -> bool:
         if not lines or not added:
             return False
-        lo, hi = lines[0], lines[-1]
-        for a in added:
-            if lo <= a <= hi:
-                return True
-        return False
+        return not added.isdisjoint(range(lines[0], lines[-1] + 1))
 
     def _zero_counts(self) -> Dict[str, int]:
         return {
@@ -113,63 +149,76 @@ class ReviewAgent:
         ]
         return [(k, v) if isinstance(v, int) else (k, 0) for k, v in order]
 
+    def _analyze_cached(self, code: str) -> Tuple[str, Dict[str, int], float]:
+        key = hashlib.blake2b(code.encode("utf-8", errors="ignore"), digest_size=16).digest()
+        hit = self._analyze_cache.get(key)
+        if hit is not None:
+            return hit
+        res = self._analyze(code)
+        if len(self._analyze_cache) >= 4096:
+            self._analyze_cache.clear()
+        self._analyze_cache[key] = res
+        return res
+
     def _analyze(self, code: str) -> Tuple[str, Dict[str, int], float]:
         counts = self._zero_counts()
         issues, conf = [], 0.5
         lines = code.splitlines()
-        todos = [i for i, l in enumerate(lines, 1) if re.search(r"(TODO|FIXME|HACK|XXX)", l, re.IGNORECASE)]
-        if todos:
-            counts["todos"] += len(todos)
-            issues.append(f"{len(todos)} TODO/FIXME")
+        nl, pos = [], code.find("\n")
+        while pos != -1:
+            nl.append(pos)
+            pos = code.find("\n", pos + 1)
+        # the per-line scans counted matching lines, not occurrences; map each
+        # match back to its line and count distinct lines per rule
+        marked = {"todo": set(), "pwd": set(), "sqli": set(), "dbg": set()}
+        for m in FUSED_SCAN.finditer(code):
+            marked[m.lastgroup].add(bisect.bisect_left(nl, m.start()))
+        hits = {k: len(v) for k, v in marked.items()}
+        hits["secret"] = len({bisect.bisect_left(nl, m.start()) for m in SECRET_RE.finditer(code)})
+        if hits["todo"]:
+            counts["todos"] += hits["todo"]
+            issues.append(f"{hits['todo']} TODO/FIXME")
             conf += 0.15
-        sec_hits = 0
-        for i, l in enumerate(lines, 1):
-            if SEC_SECRET.search(l):
-                sec_hits += 1
-                counts["secrets"] += 1
-            if SEC_PWD.search(l):
-                sec_hits += 1
-                counts["security_issues"] += 1
-            if SEC_SQLI.search(l):
-                sec_hits += 1
-                counts["security_issues"] += 1
+        sec_hits = hits["secret"] + hits["pwd"] + hits["sqli"]
         if sec_hits:
+            counts["secrets"] += hits["secret"]
+            counts["security_issues"] += hits["pwd"] + hits["sqli"]
             issues.append(f"{sec_hits} security finding(s)")
             conf += 0.25
-        longl = [1 for l in lines if len(l) > 100]
+        longl = sum(1 for l in lines if len(l) > 100)
         if longl:
-            counts["long_lines"] += len(longl)
-            issues.append(f"{len(longl)} long line(s)")
+            counts["long_lines"] += longl
+            issues.append(f"{longl} long line(s)")
             conf += 0.05
-        dbg = [1 for l in lines if DBG_PRINT.search(l)]
-        if dbg:
-            counts["debug_prints"] += len(dbg)
+        if hits["dbg"]:
+            counts["debug_prints"] += hits["dbg"]
             issues.append("debug prints")
             conf += 0.05
-        unused = self._unused_imports(code)
+        try:
+            tree = ast.parse(code)
+        except Exception:
+            tree = None
+        unused, cx = self._ast_stats(tree)
         if unused:
             counts["unused_imports"] += len(unused)
             issues.append("unused imports")
             conf += 0.05
-        perf = self._perf(code)
+        perf = self._perf(code, lines)
         if perf:
             counts["performance_issues"] += len(perf)
             issues.extend(perf)
             conf += 0.1
-        cx = self._complexity(code)
         if cx > 12:
             counts["complexity_issues"] += 1
             issues.append(f"high complexity {cx}")
             conf += 0.1
         return ", ".join(issues), counts, min(1.0, conf)
 
-    def _unused_imports(self, code: str) -> List[str]:
-        try:
-            t = ast.parse(code)
-        except Exception:
-            return []
-        imps, used = set(), set()
-        for n in ast.walk(t):
+    def _ast_stats(self, tree: ast.AST | None) -> Tuple[List[str], int]:
+        if tree is None:
+            return [], 1
+        imps, used, c = set(), set(), 1
+        for n in ast.walk(tree):
             if isinstance(n, ast.Import):
                 for a in n.names:
                     imps.add(a.asname or a.name.split(".")[0])
@@ -178,11 +227,15 @@ class ReviewAgent:
                     imps.add(a.asname or a.name)
             elif isinstance(n, ast.Name):
                 used.add(n.id)
-        return sorted([i for i in imps if i not in used])
+            elif isinstance(n, (ast.If, ast.For, ast.While, ast.ExceptHandler)):
+                c += 1
+            elif isinstance(n, ast.BoolOp):
+                c += max(0, len(getattr(n, "values", [])) - 1)
+        return sorted([i for i in imps if i not in used]), c
 
-    def _perf(self, code: str) -> List[str]:
+    def _perf(self, code: str, lines: List[str]) -> List[str]:
         out, depth = [], 0
-        for l in code.splitlines():
+        for l in lines:
             if re.match(r"^\s*(for|while)\s+", l):
                 depth += 1
                 if depth > 2:
@@ -194,33 +247,21 @@ class ReviewAgent:
             out.append("prefer enumerate over range(len())")
         return out
 
-    def _complexity(self, code: str) -> int:
-        try:
-            t = ast.parse(code)
-        except Exception:
-            return 1
-        c = 1
-        for n in ast.walk(t):
-            if isinstance(n, (ast.If, ast.For, ast.While, ast.ExceptHandler)):
-                c += 1
-            elif isinstance(n, ast.BoolOp):
-                c += max(0, len(getattr(n, "values", [])) - 1)
-        return c
-
     def _format_body(self, path: str, line: int, issues: str, neighbors: List[Dict[str, Any]], conf: float) -> str:
-        ev = []
-        for n in neighbors:
-            tag = f"{os.path.basename(n['file'])}:{n['lines'][0]}-{n['lines'][-1]}" if n.get("lines") else os.path.basename(n["file"])
-            txt = n["text"][:800]
-            ev.append(f"{tag}\n``````")
-        body = f"Issues: {redact(issues)}\nFile: {path}:{line}\nConfidence: {conf:.2f}"
-        if ev:
-            body += "\nEvidence:\n" + "\n\n".join(ev[:3])
-        return body
-
-    def _summary(self, ordered_counts: List[Tuple[str, int]], comments: List[Dict[str, Any]]) -> str:
+        parts = [f"Issues: {redact(issues)}\nFile: {path}:{line}\nConfidence: {conf:.2f}"]
+        if neighbors:
+            parts.append("\nEvidence:\n")
+            ev = []
+            for n in neighbors[:3]:
+                tag = f"{os.path.basename(n['file'])}:{n['lines'][0]}-{n['lines'][-1]}" if n.get("lines") else os.path.basename(n["file"])
+                txt = n["text"][:800]
+                ev.append(f"{tag}\n``````")
+            parts.append("\n\n".join(ev))
+        return "".join(parts)
+
+    def _summary(self, ordered_counts: List[Tuple[str, int]], comments: List[Finding]) -> str:
         total = sum(v for _, v in ordered_counts)
-        high = sum(1 for c in comments if c.get("confidence", 0) >= 0.85)
+        high = sum(1 for c in comments if c.confidence >= 0.85)
         labels = {
             "security_issues": "security",
             "secrets": "secrets",
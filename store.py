@@ -1,35 +1,238 @@
-import os, glob, json, hashlib, re
+import os, json, hashlib, re, pickle, struct, bisect
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Tuple, Any
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
 from config import Settings
 
+faiss = np = FAISS = HuggingFaceEmbeddings = DistanceStrategy = None
+
+def _load_backend() -> None:
+    # faiss, numpy and the torch-backed embeddings dominate import time; defer
+    # them so importing this module (e.g. from core) stays cheap until a store
+    # is actually constructed
+    global faiss, np, FAISS, HuggingFaceEmbeddings, DistanceStrategy
+    if faiss is None:
+        import faiss as _faiss
+        import numpy as _np
+        from langchain_huggingface import HuggingFaceEmbeddings as _HFE
+        from langchain_community.vectorstores import FAISS as _FAISS
+        from langchain_community.vectorstores.utils import DistanceStrategy as _DS
+        faiss, np, FAISS, HuggingFaceEmbeddings, DistanceStrategy = _faiss, _np, _FAISS, _HFE, _DS
+
+INDEX_EXT = frozenset({".py",".js",".ts",".tsx",".java",".go",".rb",".php",".cs",".cpp",".c",".h",".md",".yml",".yaml",".toml",".json"})
+SKIP_DIRS = frozenset({".git","node_modules","__pycache__",".venv",".rag",".mypy_cache"})
+_EXCLUDE_RE = re.compile(r"(?:^|/)(?:\.git|node_modules|__pycache__|\.venv|\.rag|\.mypy_cache)(?:/|$)")
+BOUNDARY_RE = re.compile(r"^[ \t]*(?:def |class |function |public |private |protected |fn |func )", re.MULTILINE)
+NAME_RE = re.compile(r"(?:def|class|function|fn|func)\s+([A-Za-z0-9_]+)")
+
+def _read_text(path: str) -> str | None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        if hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        head = os.read(fd, 8192)
+        if b"\x00" in head:
+            return None
+        parts = [head]
+        while True:
+            b = os.read(fd, 1 << 20)
+            if not b:
+                break
+            parts.append(b)
+        return b"".join(parts).decode("utf-8", "ignore")
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+class CompactDocstore(Docstore, AddableMixin):
+    """Docstore that packs chunk texts into one bytes blob with an int64 offset
+    table and interns file/symbol names in side tables, instead of one Document
+    object (and its dicts) per chunk. Late additions fall back to a dict."""
+
+    def __init__(self):
+        _load_backend()
+        self._blob: bytes = b""
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._pos: Dict[str, int] = {}
+        self._files: List[str] = []
+        self._file_ids = np.zeros(0, dtype=np.int32)
+        self._syms: List[str] = []
+        self._sym_ids = np.zeros(0, dtype=np.int32)
+        self._spans = np.zeros((0, 2), dtype=np.int32)
+        self._toks: List[Any] = []
+        self._extra: Dict[str, Any] = {}
+
+    @classmethod
+    def from_chunks(cls, ids: List[str], texts: List[str], metas: List[Dict[str, Any]]) -> "CompactDocstore":
+        ds = cls()
+        enc = [t.encode("utf-8") for t in texts]
+        offs = np.zeros(len(enc) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in enc], out=offs[1:])
+        ds._blob, ds._offsets = b"".join(enc), offs
+        ds._pos = {cid: i for i, cid in enumerate(ids)}
+        ftab: Dict[str, int] = {}
+        stab: Dict[str, int] = {}
+        ds._file_ids = np.zeros(len(metas), dtype=np.int32)
+        ds._sym_ids = np.zeros(len(metas), dtype=np.int32)
+        ds._spans = np.zeros((len(metas), 2), dtype=np.int32)
+        for i, m in enumerate(metas):
+            ds._file_ids[i] = ftab.setdefault(m.get("file", ""), len(ftab))
+            ds._sym_ids[i] = stab.setdefault(m.get("symbol") or "", len(stab))
+            ds._spans[i] = m.get("lines", (1, 1))
+            ds._toks.append(m.get("_toks") or frozenset())
+        ds._files, ds._syms = list(ftab), list(stab)
+        return ds
+
+    def search(self, search: str):
+        i = self._pos.get(search)
+        if i is None:
+            return self._extra.get(search, f"ID {search} not found.")
+        text = self._blob[self._offsets[i]:self._offsets[i+1]].decode("utf-8", "ignore")
+        meta = {
+            "file": self._files[self._file_ids[i]],
+            "symbol": self._syms[self._sym_ids[i]] or None,
+            "lines": (int(self._spans[i][0]), int(self._spans[i][1])),
+            "_toks": self._toks[i]
+        }
+        return Document(page_content=text, metadata=meta)
+
+    def toks(self, search: str):
+        i = self._pos.get(search)
+        return self._toks[i] if i is not None else None
+
+    def add(self, texts: Dict[str, Any]) -> None:
+        overlap = (set(texts) & set(self._pos)) | (set(texts) & set(self._extra))
+        if overlap:
+            raise ValueError(f"Tried to add ids that already exist: {overlap}")
+        self._extra.update(texts)
+
+    def delete(self, ids: List[str]) -> None:
+        for _id in ids:
+            self._pos.pop(_id, None)
+            self._extra.pop(_id, None)
+
 class EmbedStore:
     def __init__(self, settings: Settings):
+        _load_backend()
         self.settings = settings
-        self.embed = HuggingFaceEmbeddings(model_name=settings.embed_model)
+        import torch
+        if torch.cuda.is_available():
+            model_kwargs = {"device": "cuda", "model_kwargs": {"torch_dtype": torch.float16}}
+        else:
+            torch.set_num_threads(os.cpu_count() or 4)
+            model_kwargs = {"device": "cpu"}
+        self.embed = HuggingFaceEmbeddings(
+            model_name=settings.embed_model,
+            model_kwargs=model_kwargs,
+            encode_kwargs={"normalize_embeddings": True, "batch_size": settings.embed_batch, "convert_to_numpy": True}
+        )
         self.store = None
         self.dir = settings.store_dir
         self.meta_path = os.path.join(self.dir, "meta.json")
         self.manifest_path = os.path.join(self.dir, "manifest.json")
+        self.manifest_log = os.path.join(self.dir, "manifest.jsonl")
+        self._dim_cache: int | None = None
 
-    def _hash(self, s: str) -> str:
-        return hashlib.sha1(s.encode("utf-8", errors="ignore")).hexdigest()
+    def _encode(self, texts: List[str]) -> List[Any]:
+        c = getattr(self.embed, "client", None)
+        if c is not None and hasattr(c, "encode"):
+            return c.encode(texts, batch_size=self.settings.embed_batch, show_progress_bar=False, convert_to_numpy=True, normalize_embeddings=True)
+        return self.embed.embed_documents(texts)
 
     def _dim(self) -> int:
+        if self._dim_cache is not None:
+            return self._dim_cache
         c = getattr(self.embed, "client", None)
         if c and hasattr(c, "get_sentence_embedding_dimension"):
-            return int(c.get_sentence_embedding_dimension())
+            self._dim_cache = int(c.get_sentence_embedding_dimension())
+            return self._dim_cache
+        if os.path.exists(self.meta_path):
+            try:
+                with open(self.meta_path, "r") as f:
+                    meta = json.load(f)
+                if meta.get("model") == self.settings.embed_model and meta.get("dim"):
+                    self._dim_cache = int(meta["dim"])
+                    return self._dim_cache
+            except Exception:
+                pass
         v = self.embed.embed_documents(["probe"])
-        return int(len(v[0]))
+        self._dim_cache = int(len(v[0]))
+        return self._dim_cache
+
+    def _build_store(self, texts: List[str], vecs: Any, metas: List[Dict[str, Any]], ids: List[str], total: int | None = None) -> FAISS:
+        xb = np.ascontiguousarray(vecs, dtype=np.float32)
+        n, d = xb.shape
+        # the index type must reflect the whole corpus, not this batch, or
+        # incremental batches stop being mergeable into the existing store
+        if (total if total is not None else n) >= self.settings.ivf_threshold:
+            quantizer = faiss.IndexFlatIP(d)
+            index = faiss.IndexIVFPQ(quantizer, d, self.settings.nlist, self.settings.pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+            index.nprobe = self.settings.nprobe
+        else:
+            index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+        index.train(xb)
+        index.add(xb)
+        docstore = CompactDocstore.from_chunks(ids, texts, metas)
+        return FAISS(embedding_function=self.embed, index=index, docstore=docstore, index_to_docstore_id=dict(enumerate(ids)), distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT)
+
+    def _append_to_store(self, texts: List[str], vecs: Any, metas: List[Dict[str, Any]], ids: List[str]) -> None:
+        xb = np.ascontiguousarray(vecs, dtype=np.float32)
+        base = self.store.index.ntotal
+        self.store.index.add(xb)
+        self.store.docstore.add({cid: Document(page_content=t, metadata=m) for cid, t, m in zip(ids, texts, metas)})
+        for i, cid in enumerate(ids):
+            self.store.index_to_docstore_id[base + i] = cid
 
     def _load_store(self) -> None:
-        if os.path.exists(os.path.join(self.dir, "index.faiss")):
+        idx_path = os.path.join(self.dir, "index.faiss")
+        ds_path = os.path.join(self.dir, "docstore.pkl")
+        if not os.path.exists(idx_path):
+            return
+        if os.path.exists(ds_path):
+            # mmap'd indexes are read-only; incremental adds require a rebuild, hence the opt-in flag
+            flags = (faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY) if self.settings.mmap_index else 0
+            index = faiss.read_index(idx_path, flags)
+            with open(ds_path, "rb") as f:
+                (nbuf,) = struct.unpack("<I", f.read(4))
+                bufs = []
+                for _ in range(nbuf):
+                    (ln,) = struct.unpack("<Q", f.read(8))
+                    bufs.append(f.read(ln))
+                docstore, mapping = pickle.loads(f.read(), buffers=bufs)
+            self.store = FAISS(embedding_function=self.embed, index=index, docstore=docstore, index_to_docstore_id=mapping)
+        else:
             self.store = FAISS.load_local(self.dir, self.embed, allow_dangerous_deserialization=True)
+        if getattr(self.store.index, "metric_type", None) != faiss.METRIC_INNER_PRODUCT:
+            # cache restored from before the inner-product switch (e.g. an
+            # IndexFlatL2 via load_local); unmergeable with fp16 IP batches,
+            # so start clean instead of hitting the merge-failure path
+            self._reset_cache()
+            return
+        if hasattr(self.store.index, "nprobe"):
+            self.store.index.nprobe = self.settings.nprobe
 
     def _save_store(self) -> None:
-        if self.store:
-            self.store.save_local(self.dir)
+        if not self.store:
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        faiss.write_index(self.store.index, os.path.join(self.dir, "index.faiss"))
+        buffers: List[pickle.PickleBuffer] = []
+        payload = pickle.dumps((self.store.docstore, self.store.index_to_docstore_id), protocol=5, buffer_callback=buffers.append)
+        with open(os.path.join(self.dir, "docstore.pkl"), "wb") as f:
+            f.write(struct.pack("<I", len(buffers)))
+            for b in buffers:
+                raw = b.raw()
+                f.write(struct.pack("<Q", raw.nbytes))
+                f.write(raw)
+            f.write(payload)
 
     def _load_manifest(self) -> Dict[str, Any]:
         if os.path.exists(self.meta_path):
@@ -40,113 +243,266 @@ class EmbedStore:
                     return {}
             except Exception:
                 return {}
+        if os.path.exists(self.manifest_log):
+            manifest: Dict[str, Any] = {}
+            try:
+                with open(self.manifest_log, "r") as f:
+                    for ln in f:
+                        if ln.strip():
+                            rec = json.loads(ln)
+                            manifest[rec["file"]] = {"hash": rec["hash"], "ids": rec["ids"]}
+                return manifest
+            except Exception:
+                return {}
         if os.path.exists(self.manifest_path):
             try:
                 with open(self.manifest_path, "r") as f:
-                    return json.load(f)
+                    manifest = json.load(f)
+                # seed the append log with the full legacy manifest; appending
+                # only this run's updates would make the next run treat every
+                # other file as unindexed
+                self._compact_manifest(manifest)
+                return manifest
             except Exception:
                 return {}
         return {}
 
-    def _save_manifest(self, manifest: Dict[str, Any]) -> None:
+    def _compact_manifest(self, manifest: Dict[str, Any]) -> None:
+        tmp = self.manifest_log + ".tmp"
+        with open(tmp, "w") as f:
+            for fp, entry in manifest.items():
+                f.write(json.dumps({"file": fp, "hash": entry.get("hash"), "ids": entry.get("ids", [])}) + "\n")
+        os.replace(tmp, self.manifest_log)
+
+    def _save_manifest(self, manifest: Dict[str, Any], updates: List[Tuple[str, Dict[str, Any]]]) -> None:
         os.makedirs(self.dir, exist_ok=True)
-        with open(self.manifest_path, "w") as f:
-            json.dump(manifest, f)
+        if updates:
+            with open(self.manifest_log, "a") as f:
+                for fp, entry in updates:
+                    f.write(json.dumps({"file": fp, "hash": entry["hash"], "ids": entry["ids"]}) + "\n")
+            if os.path.getsize(self.manifest_log) > 4 * 1024 * 1024:
+                self._compact_manifest(manifest)
         with open(self.meta_path, "w") as f:
-            json.dump({"dim": self._dim(), "count": len(manifest)}, f)
+            json.dump({"dim": self._dim(), "count": len(manifest), "model": self.settings.embed_model}, f)
 
-    def _file_patterns(self) -> List[str]:
-        return ["*.py","*.js","*.ts","*.tsx","*.java","*.go","*.rb","*.php","*.cs","*.cpp","*.c","*.h","*.md","*.yml","*.yaml","*.toml","*.json"]
+    def _reset_cache(self) -> None:
+        self.store = None
+        for name in ("index.faiss", "docstore.pkl", "manifest.jsonl", "manifest.json", "meta.json"):
+            try:
+                os.remove(os.path.join(self.dir, name))
+            except OSError:
+                pass
+
+    def _rebuild(self, repo_path: str) -> None:
+        # the store and manifest can no longer be trusted together; drop both
+        # and reindex the whole tree in one batch rather than keep a store
+        # holding only the latest batch
+        self._reset_cache()
+        self.index_repo(repo_path)
 
     def _list_files(self, repo_path: str) -> List[str]:
-        out = []
-        for p in self._file_patterns():
-            out.extend(glob.glob(os.path.join(repo_path, "**", p), recursive=True))
-        return [f for f in out if not any(seg in f for seg in [".git","node_modules","__pycache__",".venv",".rag",".mypy_cache"])]
+        out, stack = [], [repo_path]
+        while stack:
+            d = stack.pop()
+            try:
+                entries = os.scandir(d)
+            except OSError:
+                continue
+            with entries:
+                for e in entries:
+                    # glob's leading * never matched dotfiles or descended
+                    # hidden directories; keep the indexed corpus the same
+                    if e.name.startswith("."):
+                        continue
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            if e.name not in SKIP_DIRS:
+                                stack.append(e.path)
+                        elif e.name[e.name.rfind("."):] in INDEX_EXT:
+                            out.append(e.path)
+                    except OSError:
+                        continue
+        return out
 
     def chunk_file(self, path: str) -> List[Tuple[str, Dict[str, Any]]]:
-        try:
-            with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                text = f.read()
-        except Exception:
+        text = _read_text(path)
+        if text is None:
             return []
         lines = text.splitlines()
         code_like = path.endswith((".py",".js",".ts",".tsx",".java",".go",".rb",".php",".cs",".cpp",".c",".h"))
-        chunks, cur, sym, start = [], [], None, 0
+        chunks, sym, start = [], None, 0
         if code_like:
-            for i, line in enumerate(lines):
-                if re.match(r"^\s*(def |class |function |public |private |protected |fn |func )", line):
-                    if cur:
-                        chunks.append(("\n".join(cur), {"file": path, "symbol": sym, "lines": list(range(start+1, i+1))}))
-                    cur, sym, start = [line], None, i
-                    m = re.search(r"(def|class|function|fn|func)\s+([A-Za-z0-9_]+)", line)
-                    if m:
-                        sym = m.group(2)
-                else:
-                    cur.append(line)
-            if cur:
-                chunks.append(("\n".join(cur), {"file": path, "symbol": sym, "lines": list(range(start+1, len(lines)+1))}))
+            nl, pos = [], text.find("\n")
+            while pos != -1:
+                nl.append(pos)
+                pos = text.find("\n", pos + 1)
+            for m in BOUNDARY_RE.finditer(text):
+                i = bisect.bisect_left(nl, m.start())
+                if i > start:
+                    chunks.append(("\n".join(lines[start:i]), {"file": path, "symbol": sym, "lines": (start+1, i)}))
+                start, sym = i, None
+                nm = NAME_RE.search(lines[i])
+                if nm:
+                    sym = nm.group(1)
+            if len(lines) > start:
+                chunks.append(("\n".join(lines[start:]), {"file": path, "symbol": sym, "lines": (start+1, len(lines))}))
         else:
             for i in range(0, len(lines), 80):
                 seg = lines[i:i+80]
-                chunks.append(("\n".join(seg), {"file": path, "symbol": None, "lines": list(range(i+1, min(i+81, len(lines)+1)))}))
+                chunks.append(("\n".join(seg), {"file": path, "symbol": None, "lines": (i+1, min(i+80, len(lines)))}))
+        for text, meta in chunks:
+            meta["_toks"] = frozenset(text.lower().split())
         return chunks
 
+    def _prepare(self, fp: str, prev: Dict[str, Any]) -> Tuple[str, str, List[Tuple[str, Dict[str, Any]]] | None]:
+        try:
+            with open(fp, "rb") as f:
+                fh = hashlib.file_digest(f, "blake2b").hexdigest()
+        except Exception:
+            return fp, "", None
+        if prev.get("hash") == fh and prev.get("ids"):
+            return fp, fh, None
+        return fp, fh, self.chunk_file(fp)
+
     def index_repo(self, repo_path: str, changed_files: List[str] | None = None) -> None:
         os.makedirs(self.dir, exist_ok=True)
         self._load_store()
         manifest = self._load_manifest()
-        targets = changed_files if changed_files else self._list_files(repo_path)
+        if changed_files:
+            # the scandir walk prunes these directories itself; caller-supplied
+            # paths still need the single-pass check
+            targets = [fp for fp in changed_files if not _EXCLUDE_RE.search(fp)]
+        else:
+            targets = self._list_files(repo_path)
         new_docs, new_meta, new_ids = [], [], []
-        stale_ids = set()
-        for fp in targets:
-            try:
-                with open(fp, "r", encoding="utf-8", errors="ignore") as f:
-                    content = f.read()
-            except Exception:
+        stale_ids, updates = set(), []
+        with ThreadPoolExecutor(max_workers=(os.cpu_count() or 4) * 2) as ex:
+            prepared = list(ex.map(lambda fp: self._prepare(fp, manifest.get(fp, {})), targets))
+        for fp, fh, chunks in prepared:
+            if not fh or chunks is None:
                 continue
-            fh = self._hash(content)
             prev = manifest.get(fp, {})
-            if prev.get("hash") == fh and prev.get("ids"):
-                continue
             if prev.get("ids"):
                 stale_ids.update(prev["ids"])
-            chunks = self.chunk_file(fp)
             ids = []
             for text, meta in chunks:
-                cid = f"{fp}@{meta['lines'][0]}_{meta['lines'][-1]}"
+                cid = f"{fp}@{meta['lines'][0]}_{meta['lines'][1]}"
                 ids.append(cid)
                 new_docs.append(text)
                 new_meta.append(meta)
                 new_ids.append(cid)
             manifest[fp] = {"hash": fh, "ids": ids}
-        if stale_ids and self.store and hasattr(self.store, "delete"):
+            updates.append((fp, manifest[fp]))
+        total = sum(len(e.get("ids") or []) for e in manifest.values())
+        if self.store is not None and (total >= self.settings.ivf_threshold) != isinstance(self.store.index, faiss.IndexIVF):
+            self._rebuild(repo_path)
+            return
+        if stale_ids and self.store:
+            if isinstance(self.store.index, faiss.IndexIVF):
+                # IVF remove_ids leaves surviving ids as stored, so the
+                # positional renumbering in _delete_stale would desync the
+                # position->id map; rebuild instead
+                self._rebuild(repo_path)
+                return
             try:
-                self.store.delete(list(stale_ids))
+                self._delete_stale(stale_ids)
             except Exception:
                 pass
         if new_docs:
-            fresh = FAISS.from_texts(new_docs, self.embed, metadatas=new_meta, ids=new_ids)
+            # boilerplate (license headers, generated files) repeats byte-identical
+            # chunks; encode each distinct text once and fan the vectors back out
+            uniq: Dict[bytes, int] = {}
+            uniq_texts: List[str] = []
+            rows = []
+            for t in new_docs:
+                h = hashlib.blake2b(t.encode("utf-8", errors="ignore"), digest_size=16).digest()
+                j = uniq.setdefault(h, len(uniq_texts))
+                if j == len(uniq_texts):
+                    uniq_texts.append(t)
+                rows.append(j)
+            vecs = np.ascontiguousarray(self._encode(uniq_texts), dtype=np.float32)[rows]
             if self.store:
                 try:
-                    self.store.merge_from(fresh)
+                    if isinstance(self.store.index, faiss.IndexIVF):
+                        # never merge two separately-trained IVF indexes: faiss
+                        # only checks structure, so the merge would succeed and
+                        # silently corrupt search; encode with the existing
+                        # trained centroids instead
+                        self._append_to_store(new_docs, vecs, new_meta, new_ids)
+                    else:
+                        fresh = self._build_store(new_docs, vecs, new_meta, new_ids, total=total)
+                        self.store.merge_from(fresh)
                 except Exception:
-                    self.store = fresh
+                    self._rebuild(repo_path)
+                    return
             else:
-                self.store = fresh
+                self.store = self._build_store(new_docs, vecs, new_meta, new_ids, total=total)
             self._save_store()
-        self._save_manifest(manifest)
+        self._save_manifest(manifest, updates)
+
+    def _delete_stale(self, stale_ids: Any) -> None:
+        # one remove_ids call with an int64 batch (faiss wraps it in an
+        # IDSelectorBatch) instead of langchain's per-id bookkeeping, and
+        # tolerant of ids that never made it into the index
+        id_map = self.store.index_to_docstore_id
+        dead = sorted(p for p, did in id_map.items() if did in stale_ids)
+        if not dead:
+            return
+        self.store.index.remove_ids(np.asarray(dead, dtype=np.int64))
+        self.store.docstore.delete([id_map[p] for p in dead])
+        dead_set = set(dead)
+        self.store.index_to_docstore_id = dict(enumerate(did for p, did in sorted(id_map.items()) if p not in dead_set))
+
+    def _knn(self, queries: List[str], qv: Any, k: int) -> List[List[Tuple[str, Dict[str, Any], float]]]:
+        q = np.ascontiguousarray(qv, dtype=np.float32)
+        if q.ndim == 1:
+            q = q[None, :]
+        D, I = self.store.index.search(q, k * 2)
+        ds = self.store.docstore
+        id_map = self.store.index_to_docstore_id
+        compact = isinstance(ds, CompactDocstore)
+        out = []
+        for qi, text in enumerate(queries):
+            toks = frozenset(text.lower().split())
+            dids, dists = [], []
+            for pos, dist in zip(I[qi], D[qi]):
+                did = id_map.get(int(pos)) if pos >= 0 else None
+                if did is not None:
+                    dids.append(did)
+                    dists.append(dist)
+            if not dids:
+                out.append([])
+                continue
+            overlaps = np.zeros(len(dids), dtype=np.float32)
+            resolved: List[Any] = [None] * len(dids)
+            for j, did in enumerate(dids):
+                ctoks = ds.toks(did) if compact else None
+                if ctoks is None:
+                    doc = ds.search(did)
+                    if isinstance(doc, str):
+                        continue
+                    resolved[j] = doc
+                    ctoks = doc.metadata.get("_toks") or frozenset(doc.page_content.lower().split())
+                overlaps[j] = len(toks & ctoks) / max(1, len(toks))
+            # inner-product scores: higher is better, so overlap is an additive boost
+            adj = np.asarray(dists, dtype=np.float32) + np.minimum(0.3, overlaps * 0.3)
+            sel = np.argpartition(-adj, min(k, len(adj)) - 1)[:k]
+            sel = sel[np.argsort(-adj[sel])]
+            res = []
+            for j in sel:
+                doc = resolved[j] if resolved[j] is not None else ds.search(dids[j])
+                if isinstance(doc, str):
+                    continue
+                res.append((doc.page_content, doc.metadata, float(adj[j])))
+            out.append(res)
+        return out
 
     def hybrid_search(self, text: str, k: int) -> List[Tuple[str, Dict[str, Any], float]]:
         if not self.store:
             return []
-        res = self.store.similarity_search_with_score(text, k=k*2)
-        toks = set(text.lower().split())
-        out = []
-        for doc, score in res:
-            ctoks = set(doc.page_content.lower().split())
-            overlap = len(toks & ctoks) / max(1, len(toks))
-            adj = score * (1 - min(0.3, overlap*0.3))
-            out.append((doc.page_content, doc.metadata, adj))
-        out.sort(key=lambda x: x[2])
-        return out[:k]
+        return self._knn([text], self.embed.embed_query(text), k)[0]
+
+    def hybrid_search_batch(self, queries: List[str], k: int) -> List[List[Tuple[str, Dict[str, Any], float]]]:
+        if not self.store or not queries:
+            return [[] for _ in queries]
+        return self._knn(queries, self._encode(queries), k)